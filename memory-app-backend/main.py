@@ -1,26 +1,118 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
+import asyncio
+import hashlib
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime
+from operator import itemgetter
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
-from processor import AudioProcessor  # our diarization+transcription pipeline
-
-app = FastAPI(title="Memory App Backend")
+from worker import connect, serve  # our diarization+transcription pipeline
 
 # Ensure uploads directory exists
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-# Create a global processor and thread pool for parallel processing
-# Adjust max_workers based on how many files you want to process in parallel
-processor = AudioProcessor()
-executor = ThreadPoolExecutor(max_workers=3)
+# Uploads are streamed to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Models live in a single processing worker (see worker.py), fed from a job queue
+queue = asyncio.Queue()
+
+# Connection to the processing worker (None while it is unreachable)
+worker_conn = None
+
+# How often, and how far apart (seconds), to retry reaching a lost worker
+WORKER_RECONNECT_ATTEMPTS = 5
+WORKER_RECONNECT_DELAY = 2.0
+
+
+def run_job(conn, path, content_hash):
+    """Send a job to the processing worker and wait for its reply"""
+    conn.send((path, content_hash))
+    status, payload = conn.recv()
+    if status != "ok":
+        raise RuntimeError(payload)
+    return payload
+
+
+async def reconnect():
+    """Reconnect to the processing worker, retrying a few times before giving up"""
+    global worker_conn
+    for attempt in range(WORKER_RECONNECT_ATTEMPTS):
+        try:
+            worker_conn = await asyncio.to_thread(connect)
+            print("✓ Reconnected to processing worker")
+            return
+        except (RuntimeError, EOFError, OSError) as e:
+            print(f"✗ Processing worker unreachable ({attempt + 1}/{WORKER_RECONNECT_ATTEMPTS}): {str(e)}")
+            await asyncio.sleep(WORKER_RECONNECT_DELAY)
+    raise RuntimeError("processing worker unreachable")
+
+
+async def submit(path, content_hash):
+    """Run a job on the processing worker, reconnecting and retrying once if it was lost"""
+    global worker_conn
+    if worker_conn is not None:
+        try:
+            return await asyncio.to_thread(run_job, worker_conn, path, content_hash)
+        except (EOFError, OSError):
+            # Worker crashed or was restarted
+            print("✗ Lost connection to processing worker, reconnecting...")
+            worker_conn.close()
+            worker_conn = None
+
+    await reconnect()
+    return await asyncio.to_thread(run_job, worker_conn, path, content_hash)
+
+
+async def worker():
+    """Process queued files one at a time"""
+    while True:
+        path, content_hash = await queue.get()
+        try:
+            await submit(path, content_hash)
+        except Exception as e:
+            print(f"✗ Processing failed for {path}: {str(e)}")
+        finally:
+            queue.task_done()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global worker_conn
+
+    # Fails startup if the processing worker isn't running
+    worker_conn = await asyncio.to_thread(connect)
+
+    task = asyncio.create_task(worker())
+    yield
+    task.cancel()
+
+    if worker_conn is not None:
+        worker_conn.close()
+
+
+app = FastAPI(
+    title="Memory App Backend",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
 @app.get("/")
 async def root():
-    """Health check endpoint"""
+    """Health check endpoint (503 while the processing worker is unreachable)"""
+    if worker_conn is None:
+        return ORJSONResponse(
+            status_code=503,
+            content={
+                "status": "degraded",
+                "message": "Processing worker is unreachable",
+                "timestamp": datetime.now().isoformat()
+            },
+        )
+
     return {
         "status": "running",
         "message": "Memory App Backend is running",
@@ -32,7 +124,7 @@ async def root():
 async def upload_audio(file: UploadFile = File(...)):
     """
     Receive audio file uploads from iOS app
-    Schedule processing in background thread pool
+    Queue processing for the background worker
     """
     try:
         # Validate file type
@@ -42,22 +134,26 @@ async def upload_audio(file: UploadFile = File(...)):
         # Save file
         file_path = UPLOAD_DIR / file.filename
 
-        # Read and write file
-        contents = await file.read()
+        # Stream file to disk without buffering it all in memory,
+        # hashing as we go so the processor can look up cached results
+        digest = hashlib.sha256()
         with open(file_path, "wb") as f:
-            f.write(contents)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
 
         # Get file size
-        file_size = len(contents)
+        file_size = file_path.stat().st_size
 
         print(f"✓ Received: {file.filename} ({file_size} bytes)")
 
-        # Submit processing job to thread pool (non-blocking)
-        future = executor.submit(processor.process, str(file_path))
-        print(f"  → Queued for processing (future: {future})")
+        # Queue processing job for the worker (non-blocking)
+        # Absolute path, since the worker may run from another directory
+        await queue.put((str(file_path.resolve()), digest.hexdigest()))
+        print(f"  → Queued for processing (position: {queue.qsize()})")
 
         # Immediately return success to the client
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=200,
             content={
                 "status": "success",
@@ -72,33 +168,66 @@ async def upload_audio(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 
+def scan_uploads():
+    """Return (name, stat) for every uploaded .m4a file"""
+    with os.scandir(UPLOAD_DIR) as it:
+        return [(e.name, e.stat()) for e in it if e.name.endswith(".m4a")]
+
+
 @app.get("/api/files")
 async def list_files():
     """List all uploaded files"""
     try:
+        # Scan the directory off the event loop
+        entries = await asyncio.to_thread(scan_uploads)
+
         files = []
-        for file_path in UPLOAD_DIR.glob("*.m4a"):
-            stat = file_path.stat()
+        for name, stat in entries:
             files.append(
                 {
-                    "filename": file_path.name,
+                    "filename": name,
                     "size": stat.st_size,
-                    "created": datetime.fromtimestamp(stat.st_ctime).isoformat(),
+                    "created": datetime.fromtimestamp(stat.st_ctime),
                 }
             )
 
-        files.sort(key=lambda x: x["created"], reverse=True)
+        files.sort(key=itemgetter("created"), reverse=True)
 
-        return {
-            "count": len(files),
-            "files": files,
-        }
+        # Returned directly so orjson formats the datetimes itself
+        return ORJSONResponse(
+            content={
+                "count": len(files),
+                "files": files,
+            },
+        )
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 if __name__ == "__main__":
+    import multiprocessing
     import uvicorn
 
+    # Random secret shared with the processing worker; set in the environment
+    # so connect() in the lifespan picks it up
+    authkey = os.urandom(32).hex()
+    os.environ["WORKER_AUTHKEY"] = authkey
+
+    # Start the processing worker and wait until its models are loaded
+    # "spawn" since CUDA can't be initialized in a forked process
+    ctx = multiprocessing.get_context("spawn")
+    ready, child_ready = ctx.Pipe()
+    process = ctx.Process(target=serve, args=(authkey.encode(), child_ready), daemon=True)
+    process.start()
+    child_ready.close()
+
+    try:
+        status, payload = ready.recv()
+    except EOFError:
+        process.join()
+        status, payload = "error", f"exited with code {process.exitcode}"
+    if status != "ready":
+        raise RuntimeError(f"Processing worker failed to start: {payload}")
+
     uvicorn.run(app, host="0.0.0.0", port=5001)
\ No newline at end of file
@@ -1,8 +1,51 @@
+import hashlib
+import json
 import os
+import av
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from faster_whisper import WhisperModel
 from pyannote.audio import Pipeline
-import speech_recognition as sr
 from pathlib import Path
-from pydub import AudioSegment
+
+# Both pyannote and Whisper expect 16kHz mono audio
+SAMPLE_RATE = 16000
+
+# Let cuDNN pick the fastest conv kernels for our input shapes
+torch.backends.cudnn.benchmark = True
+
+# Opt-in: run the diarization networks in FP16/TF32 (not yet validated against FP32)
+DIARIZATION_FP16 = os.getenv("DIARIZATION_FP16") == "1"
+
+# Opt-in: torch.compile the diarization networks (not yet validated on GPU)
+DIARIZATION_COMPILE = os.getenv("DIARIZATION_COMPILE") == "1"
+
+# Words are matched to speaker turns in blocks of this many
+WORD_BLOCK_SIZE = 1024
+
+# Consecutive turns from the same speaker closer than this (seconds) are merged
+MAX_MERGE_GAP = 0.5
+
+
+def fp16_forward(forward):
+    """
+    Wrap a module's forward to run under CUDA FP16 autocast,
+    casting floating-point outputs back to FP32 for pyannote's post-processing
+    """
+    def to_fp32(output):
+        if isinstance(output, tuple):
+            return tuple(to_fp32(o) for o in output)
+        if torch.is_tensor(output) and output.is_floating_point():
+            return output.float()
+        return output
+    
+    def wrapped(*args, **kwargs):
+        with torch.autocast("cuda", dtype=torch.float16):
+            return to_fp32(forward(*args, **kwargs))
+    
+    return wrapped
+
 
 class AudioProcessor:
     def __init__(self):
@@ -16,35 +59,130 @@ class AudioProcessor:
             "pyannote/speaker-diarization-3.1",
             use_auth_token=hf_token
         )
-        print("✓ Pyannote loaded")
         
-        # Initialize speech recognizer
-        self.recognizer = sr.Recognizer()
-        print("✓ Speech recognizer ready")
+        # Run diarization on the GPU when one is available
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.diarization_pipeline.to(self.device)
+        
+        # Dedicated stream so diarization kernels can overlap with Whisper's
+        self.diarization_stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        
+        if self.device.type == "cuda":
+            if DIARIZATION_FP16:
+                self.enable_fp16()
+            self.tune_batch_sizes()
+            if DIARIZATION_COMPILE:
+                self.compile_models()
+        else:
+            self.quantize_models()
+        print(f"✓ Pyannote loaded (device: {self.device})")
+        
+        # Initialize Whisper (CTranslate2 backend with INT8 weights)
+        compute_type = "int8_float16" if self.device.type == "cuda" else "int8"
+        self.asr = WhisperModel("small", device=self.device.type, compute_type=compute_type)
+        print(f"✓ Whisper loaded ({compute_type})")
     
-    def convert_to_wav(self, audio_path):
-        """Convert M4A to WAV for better compatibility"""
-        wav_path = str(audio_path).replace('.m4a', '.wav')
+    def quantize_models(self):
+        """
+        Apply INT8 dynamic quantization to the segmentation model's LSTM/Linear layers
+        (CPU only, quantized kernels are not available on CUDA)
+        The embedding model is left as is: it is almost entirely Conv2d, which
+        dynamic quantization doesn't cover
+        """
+        segmentation = self.diarization_pipeline._segmentation
+        segmentation.model = torch.ao.quantization.quantize_dynamic(
+            segmentation.model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8
+        )
         
-        if not os.path.exists(wav_path):
-            print(f"Converting {audio_path} to WAV...")
-            audio = AudioSegment.from_file(audio_path, format="m4a")
-            audio.export(wav_path, format="wav")
-            print(f"✓ Converted to {wav_path}")
+        print("✓ Segmentation model LSTM/Linear layers quantized to INT8 (embedding model unchanged)")
+    
+    def enable_fp16(self):
+        """
+        Run the segmentation and embedding networks under FP16 autocast
+        (and allow TF32 matmuls), enabled with DIARIZATION_FP16=1
+        The embedding's fbank front-end stays in FP32: pyannote scales the
+        waveform by 2^15, so its power spectrum overflows FP16
+        """
+        torch.backends.cuda.matmul.allow_tf32 = True
+        
+        segmentation = self.diarization_pipeline._segmentation
+        segmentation.model.forward = fp16_forward(segmentation.model.forward)
         
-        return wav_path
+        embedding = self.diarization_pipeline._embedding
+        if hasattr(embedding, "model_") and hasattr(embedding.model_, "resnet"):
+            embedding.model_.resnet.forward = fp16_forward(embedding.model_.resnet.forward)
+        
+        print("✓ Diarization networks set to FP16")
     
-    def diarize(self, audio_path):
+    def tune_batch_sizes(self):
         """
-        Perform speaker diarization on audio file
-        Returns: dict with speaker segments
+        Pick segmentation/embedding batch sizes from available VRAM:
+        large enough to keep the GPU busy, small enough not to OOM
+        """
+        total_gb = torch.cuda.get_device_properties(self.device).total_memory / 1024**3
+        
+        if total_gb < 12:
+            batch_size = 32
+        elif total_gb <= 24:
+            batch_size = 64
+        else:
+            batch_size = 128
+        
+        self.diarization_pipeline.segmentation_batch_size = batch_size
+        self.diarization_pipeline.embedding_batch_size = batch_size
+        print(f"✓ Diarization batch size set to {batch_size} ({total_gb:.0f}GB VRAM)")
+    
+    def compile_models(self):
         """
-        # Convert to WAV first
-        wav_path = self.convert_to_wav(audio_path)
+        Compile the segmentation and embedding models with torch.compile,
+        enabled with DIARIZATION_COMPILE=1
+        (fuses pointwise ops; the first diarization run pays the compile cost)
+        Default mode without CUDA graphs, and dynamic shapes, since pyannote's
+        last batch is usually smaller than the batch size
+        """
+        segmentation = self.diarization_pipeline._segmentation
+        segmentation.model = torch.compile(segmentation.model, dynamic=True)
+        
+        embedding = self.diarization_pipeline._embedding
+        if hasattr(embedding, "model_"):
+            embedding.model_ = torch.compile(embedding.model_, dynamic=True)
         
-        print(f"Running diarization on {wav_path}...")
+        print("✓ Diarization models compiled")
+    
+    def load_audio(self, audio_path):
+        """
+        Decode M4A in-process to 16kHz mono float32 samples (kept in memory only)
+        """
+        print(f"Decoding {audio_path}...")
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=SAMPLE_RATE)
+        chunks = []
+        with av.open(str(audio_path)) as container:
+            for frame in container.decode(audio=0):
+                for resampled in resampler.resample(frame):
+                    chunks.append(resampled.to_ndarray().reshape(-1))
+        for resampled in resampler.resample(None):
+            chunks.append(resampled.to_ndarray().reshape(-1))
         
-        diarization = self.diarization_pipeline(wav_path)
+        samples = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+        print(f"✓ Decoded {len(samples) / SAMPLE_RATE:.1f}s of audio")
+        
+        return samples, SAMPLE_RATE
+    
+    def diarize(self, samples, sample_rate):
+        """
+        Perform speaker diarization on decoded audio
+        samples: 16kHz mono float32 numpy array (from load_audio)
+        Returns: dict with speaker segments
+        """
+        print("Running diarization...")
+        
+        with torch.cuda.stream(self.diarization_stream), torch.inference_mode():
+            # Copied on the diarization stream so it is ordered before the pipeline's kernels
+            waveform = torch.from_numpy(samples).unsqueeze(0).to(self.device)
+            
+            diarization = self.diarization_pipeline(
+                {"waveform": waveform, "sample_rate": sample_rate}
+            )
         
         segments = []
         for turn, _, speaker in diarization.itertracks(yield_label=True):
@@ -58,60 +196,128 @@ class AudioProcessor:
         print(f"✓ Found {len(set(s['speaker'] for s in segments))} speaker(s)")
         return segments
     
-    def transcribe_segment(self, audio_path, start, end):
+    def merge_segments(self, segments):
+        """
+        Merge consecutive turns from the same speaker separated by less than
+        MAX_MERGE_GAP seconds (pyannote often splits one utterance into many)
+        """
+        merged = []
+        for seg in segments:
+            if merged and seg['speaker'] == merged[-1]['speaker'] and seg['start'] - merged[-1]['end'] < MAX_MERGE_GAP:
+                merged[-1]['end'] = max(merged[-1]['end'], seg['end'])
+                merged[-1]['duration'] = merged[-1]['end'] - merged[-1]['start']
+            else:
+                merged.append(dict(seg))
+        return merged
+    
+    def transcribe(self, samples):
         """
-        Transcribe a specific segment of audio
+        Transcribe the whole recording with word-level timestamps
+        Whisper encodes fixed 30s windows, so this is one encoder pass per
+        30s of audio instead of one per diarization segment
+        samples: 16kHz mono float32 numpy array
+        Returns: list of (start, end, word), or None if transcription failed
         """
-        wav_path = self.convert_to_wav(audio_path)
+        print("Transcribing...")
         
-        # Load audio
-        audio = AudioSegment.from_wav(wav_path)
+        try:
+            segments, _ = self.asr.transcribe(
+                samples, language="en", beam_size=1, vad_filter=False, word_timestamps=True
+            )
+            words = [(w.start, w.end, w.word) for s in segments for w in s.words]
         
-        # Extract segment (times are in seconds, pydub uses milliseconds)
-        segment = audio[int(start * 1000):int(end * 1000)]
+        except Exception as e:
+            print(f"  ✗ Transcription failed: {e}")
+            return None
         
-        # Save temporary segment
-        temp_path = wav_path.replace('.wav', f'_temp_{start}_{end}.wav')
-        segment.export(temp_path, format="wav")
+        print(f"✓ Transcribed {len(words)} word(s)")
+        return words
+    
+    def assign_words(self, words, segments):
+        """
+        Assign each word to the diarization turn containing (or nearest to) it
+        Returns: list of texts, one per segment
+        """
+        if not segments:
+            return []
         
-        try:
-            # Transcribe the segment
-            with sr.AudioFile(temp_path) as source:
-                audio_data = self.recognizer.record(source)
-            
-            text = self.recognizer.recognize_whisper(audio_data)
-            
-            # Clean up temp file
-            os.remove(temp_path)
-            
-            return text.strip()
+        if not words:
+            return ["" for _ in segments]
         
-        except Exception as e:
-            print(f"  ✗ Segment transcription failed: {e}")
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            return ""
+        starts = np.array([seg['start'] for seg in segments])
+        ends = np.array([seg['end'] for seg in segments])
+        mids = np.array([(start + end) / 2 for start, end, _ in words])
+        
+        # Distance from each word to each turn (0 when inside it), computed in
+        # blocks of words to bound the size of the words x turns matrix
+        owners = np.empty(len(words), dtype=np.int64)
+        for i in range(0, len(words), WORD_BLOCK_SIZE):
+            block = mids[i:i + WORD_BLOCK_SIZE, None]
+            distances = np.maximum(np.maximum(starts - block, block - ends), 0)
+            owners[i:i + WORD_BLOCK_SIZE] = distances.argmin(axis=1)
+        
+        texts = [[] for _ in segments]
+        for owner, (_, _, word) in zip(owners.tolist(), words):
+            texts[owner].append(word)
+        
+        return ["".join(tokens).strip() for tokens in texts]
+    
+    def release_memory(self):
+        """Return cached CUDA memory to the driver between jobs"""
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+    
+    def hash_file(self, audio_path):
+        """SHA-256 of the file contents"""
+        digest = hashlib.sha256()
+        with open(audio_path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+        return digest.hexdigest()
     
-    def process(self, audio_path):
+    def process(self, audio_path, content_hash=None):
         """
         Complete processing: diarization + transcription per segment
+        Results are cached by content hash in uploads/.cache/
         """
         print(f"\n{'='*60}")
         print(f"Processing: {Path(audio_path).name}")
         print(f"{'='*60}")
         
-        # Diarize
-        segments = self.diarize(audio_path)
+        # Identical content (re-uploads, retries) reuses the cached result
+        if content_hash is None:
+            content_hash = self.hash_file(audio_path)
+        cache_path = Path(audio_path).parent / ".cache" / f"{content_hash}.json"
         
-        # Transcribe each segment
-        print(f"Transcribing {len(segments)} segment(s)...")
+        if cache_path.exists():
+            print(f"✓ Cache hit ({content_hash[:12]}), skipping pipeline")
+            result = json.loads(cache_path.read_text())
+            result["file"] = str(audio_path)
+            return result
+        
+        samples, sample_rate = self.load_audio(audio_path)
+        
+        if self.device.type == "cuda":
+            # Transcription doesn't depend on the speaker turns, so on GPU run
+            # Whisper over the whole recording in the background while pyannote diarizes
+            pool = ThreadPoolExecutor(max_workers=1)
+            try:
+                words_future = pool.submit(self.transcribe, samples)
+                segments = self.diarize(samples, sample_rate)
+                words = words_future.result()
+            finally:
+                # If diarization fails, report it without waiting for Whisper
+                pool.shutdown(wait=False)
+        else:
+            # On CPU both would compete for the same cores, so run them in turn
+            segments = self.diarize(samples, sample_rate)
+            words = self.transcribe(samples)
+        
+        segments = self.merge_segments(segments)
+        texts = self.assign_words(words or [], segments)
         
         labeled_segments = []
-        for i, seg in enumerate(segments):
-            print(f"  [{i+1}/{len(segments)}] Transcribing {seg['speaker']} ({seg['start']:.1f}s - {seg['end']:.1f}s)...")
-            
-            text = self.transcribe_segment(audio_path, seg['start'], seg['end'])
-            
+        for seg, text in zip(segments, texts):
             labeled_segments.append({
                 "speaker": seg['speaker'],
                 "start": seg['start'],
@@ -119,8 +325,6 @@ class AudioProcessor:
                 "duration": seg['duration'],
                 "text": text
             })
-            
-            print(f"    ✓ \"{text}\"")
         
         # Combine results
         result = {
@@ -129,6 +333,15 @@ class AudioProcessor:
             "num_speakers": len(set(s['speaker'] for s in segments))
         }
         
+        # Don't cache a failed transcription, so a retry runs the pipeline again
+        if words is not None:
+            cache_path.parent.mkdir(exist_ok=True)
+            
+            # Write to a temp file and rename, so a crash never leaves truncated JSON
+            tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+            tmp_path.write_text(json.dumps(result))
+            os.replace(tmp_path, cache_path)
+        
         print(f"\n{'='*60}")
         print("RESULTS:")
         print(f"Speakers detected: {result['num_speakers']}")
@@ -162,7 +375,6 @@ def test_processor():
     print("\n" + "="*60)
     print("FULL RESULT DICTIONARY:")
     print("="*60)
-    import json
     print(json.dumps(result, indent=2))
     print("="*60 + "\n")
     
@@ -0,0 +1,139 @@
+"""
+Processing worker: loads the diarization + transcription models once and
+serves jobs to the API over a multiprocessing connection.
+
+`python main.py` starts it automatically. When running the API under
+`uvicorn main:app --workers N`, start it once beforehand with `python worker.py`
+so the models are loaded a single time for all workers.
+
+The connection unpickles what it receives, so it is only exposed on a Unix
+socket readable by the current user, and both sides must share WORKER_AUTHKEY
+(`python main.py` generates a random one).
+
+This module only uses the standard library at import time; the models are
+imported inside serve(), so the API process never loads torch/pyannote.
+"""
+import os
+import socket
+import tempfile
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+# Unix socket the processing worker listens on for jobs from the API
+WORKER_SOCKET = os.getenv(
+    "WORKER_SOCKET", os.path.join(tempfile.gettempdir(), "memory-app-worker.sock")
+)
+
+
+def get_authkey():
+    """Shared secret for the worker connection, from WORKER_AUTHKEY"""
+    authkey = os.getenv("WORKER_AUTHKEY")
+    if not authkey:
+        raise RuntimeError("WORKER_AUTHKEY environment variable not set")
+    return authkey.encode()
+
+
+def connect():
+    """Connect to the processing worker and wait for its ready message"""
+    try:
+        conn = Client(WORKER_SOCKET, family="AF_UNIX", authkey=get_authkey())
+    except (FileNotFoundError, ConnectionRefusedError):
+        raise RuntimeError(
+            f"Processing worker not running on {WORKER_SOCKET} "
+            "(start it with `python worker.py`)"
+        )
+    
+    status, payload = conn.recv()
+    if status != "ready":
+        raise RuntimeError(f"Processing worker not ready: {payload}")
+    
+    return conn
+
+
+def handle(conn, processor, lock):
+    """Handle (path, content_hash) jobs from one API process until it disconnects"""
+    with conn:
+        conn.send(("ready", None))
+        
+        while True:
+            try:
+                path, content_hash = conn.recv()
+            except (EOFError, OSError):
+                # API process went away
+                break
+            
+            # One job at a time across all API processes: parallel pipelines
+            # on one GPU only compete for VRAM
+            with lock:
+                try:
+                    reply = ("ok", processor.process(path, content_hash))
+                except Exception as e:
+                    reply = ("error", str(e))
+                finally:
+                    processor.release_memory()
+            
+            try:
+                conn.send(reply)
+            except OSError:
+                break
+
+
+def listen(authkey):
+    """Create the worker's Listener on a Unix socket only the current user can access"""
+    if os.path.exists(WORKER_SOCKET):
+        with socket.socket(socket.AF_UNIX) as probe:
+            if probe.connect_ex(WORKER_SOCKET) == 0:
+                raise RuntimeError(f"Processing worker already running on {WORKER_SOCKET}")
+        # Stale socket left behind by a worker that didn't shut down cleanly
+        os.unlink(WORKER_SOCKET)
+    
+    # Socket file is created with 0600 permissions
+    old_umask = os.umask(0o177)
+    try:
+        return Listener(WORKER_SOCKET, family="AF_UNIX", authkey=authkey)
+    finally:
+        os.umask(old_umask)
+
+
+def serve(authkey, ready=None):
+    """
+    Bind the socket and load the models, then accept connections from API processes
+    (clients connecting while the models load wait until they are ready)
+    authkey: shared secret clients must present (see get_authkey)
+    ready: optional Connection that receives ("ready", None) once the models are
+    loaded and the worker is listening, or ("error", message) if loading failed
+    """
+    listener = None
+    try:
+        # Bind before loading the models, so a socket already in use fails fast
+        listener = listen(authkey)
+        
+        from processor import AudioProcessor
+        processor = AudioProcessor()
+    except Exception as e:
+        if listener is not None:
+            listener.close()
+        if ready is not None:
+            ready.send(("error", str(e)))
+        raise
+    
+    lock = threading.Lock()
+    with listener:
+        print(f"✓ Processing worker listening on {WORKER_SOCKET}")
+        if ready is not None:
+            ready.send(("ready", None))
+        
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError, OSError) as e:
+                # A client failing the handshake must not take the worker down
+                print(f"✗ Rejected worker connection: {e}")
+                continue
+            threading.Thread(target=handle, args=(conn, processor, lock), daemon=True).start()
+
+
+if __name__ == "__main__":
+    # Refuses to start without WORKER_AUTHKEY
+    serve(get_authkey())